@@ -1,152 +1,278 @@
 import os
 import argparse
 import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import mrcfile
 import numpy as np
 import pandas as pd
 
 
+_REF_RE = re.compile(r'^(\d+)@(.+)$')
+
+# Whole-line comments in a star file data block
+_COMMENT_LINE_RE = re.compile(r'^[ \t]*#.*\n?', re.MULTILINE)
+
+# MRC modes for the supported output data types
+_MRC_MODES = {'float32': 2, 'float16': 12, 'int16': 1}
+_FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+
 def parse_image_reference(ref_string):
     """
     Parse Relion's image reference format: 000index@filename.mrc
     Returns (index, filename)
     """
-    if match := re.match(r'(\d+)@(.+)', ref_string):
+    if match := _REF_RE.match(ref_string):
         return int(match[1]), match[2]
     else:
         raise ValueError(f"Invalid image reference format: {ref_string}")
 
 
+class _CommentLineFilter:
+    """
+    Wrap a text file so lines starting with '#' are dropped as it is read.
+    A '#' inside a field is kept. pd.read_csv can still read the file in
+    chunks through this wrapper.
+    """
+    
+    def __init__(self, f):
+        self._f = f
+        self._partial = ''
+    
+    def __iter__(self):
+        # pandas only treats objects with __iter__ as files; its C parser uses read()
+        return (line for line in self._f if not _COMMENT_LINE_RE.match(line))
+    
+    def read(self, size=-1):
+        while True:
+            chunk = self._f.read(size)
+            text = self._partial + chunk
+            self._partial = ''
+            if chunk and size is not None and size >= 0:
+                # Hold back an unfinished last line so comments are only matched on whole lines
+                cut = text.rfind('\n') + 1
+                text, self._partial = text[:cut], text[cut:]
+            if '#' in text:
+                text = _COMMENT_LINE_RE.sub('', text)
+            # An empty result means end of file, so keep reading past chunks that were all comments
+            if text or not chunk:
+                return text
+
+
 def read_star_file(star_file_path, image_column_name):
     """
     Read a Relion star file and extract the image references.
-    Returns a DataFrame with the star file data.
+    Returns a DataFrame with the star file data and the header text
+    (everything up to and including the last column header line).
     """
-    # Read the star file
-    with open(star_file_path, 'r') as f:
-        lines = f.readlines()
-    
-    # Find the data block
     data_start = None
     header_start = None
     column_names = []
+    header_lines = []
     
-    for i, line in enumerate(lines):
-        if line.strip() == "data_particles" or line.strip() == "data_":
-            data_start = i
-        elif line.strip() == "loop_" and data_start is not None:
-            header_start = i + 1
-        elif header_start is not None and line.strip() and line.strip()[0] == '_':
-            column_names.append(line.strip().split()[0][1:])  # Remove leading '_'
-        elif header_start is not None and column_names and (not line.strip() or line.strip()[0] != '_'):
-            data_start = i
-            break
-    
-    if header_start is None or data_start is None:
-        raise ValueError("Could not parse star file format")
-    
-    # Read the data rows
-    data_rows = []
-    for line in lines[data_start:]:
-        if line.strip() and not line.strip().startswith('#'):
-            data_rows.append(line.strip().split())
-    
-    # Create DataFrame
-    df = pd.DataFrame(data_rows, columns=column_names)
+    # Stream through the header, stopping at the first data row
+    with open(star_file_path, 'r') as f:
+        pos = f.tell()
+        while line := f.readline():
+            if line.strip() == "data_particles" or line.strip() == "data_":
+                data_start = pos
+            elif line.strip() == "loop_" and data_start is not None:
+                header_start = f.tell()
+            elif header_start is not None and line.strip() and line.strip()[0] == '_':
+                column_names.append(line.strip().split()[0][1:])  # Remove leading '_'
+            elif header_start is not None and column_names and (not line.strip() or line.strip()[0] != '_'):
+                data_start = pos
+                break
+            header_lines.append(line)
+            pos = f.tell()
+        
+        if header_start is None or data_start is None:
+            raise ValueError("Could not parse star file format")
+        
+        # Hand the rest of the file to pandas' C parser, keeping every value as its original text
+        f.seek(pos)
+        df = pd.read_csv(_CommentLineFilter(f), sep=r'\s+', names=column_names, header=None,
+                         dtype=str, keep_default_na=False, na_filter=False, engine='c')
+    
+    header_text = ''.join(header_lines)
     
     # Verify the image column exists
     if image_column_name not in df.columns:
         raise ValueError(f"Column '{image_column_name}' not found in star file")
     
-    return df
+    return df, header_text
+
+
+def _open_mrc(filepath):
+    """
+    Memory-map an MRC file for reading.
+    """
+    try:
+        return mrcfile.mmap(filepath, mode='r')
+    except FileNotFoundError as e:
+        raise FileNotFoundError(f"MRC file not found: {filepath}") from e
+
+
+def _iter_images(mrc, filename, items):
+    """
+    Yield (output_position, image) for the requested images of an open MRC file.
+    items is a list of (output_position, image_index) pairs.
+    """
+    # Read images in file order so access to the stack is sequential
+    items.sort(key=lambda item: item[1])
+    for out_pos, img_idx in items:
+        # Extract the specific image from the stack
+        if mrc.data.ndim == 3:  # It's a stack
+            if img_idx >= mrc.data.shape[0]:
+                raise IndexError(f"Image index {img_idx} out of bounds for file {filename}")
+            yield out_pos, mrc.data[img_idx]
+        else:  # It's a single image
+            if img_idx != 0:
+                raise IndexError(f"Image index {img_idx} invalid for single image file {filename}")
+            yield out_pos, mrc.data
 
 
-def process_images(df, image_column, input_dir, output_stack_path):
+def _images_max_abs(mrc, filename, items):
+    """
+    Return the largest absolute pixel value among the requested images of an open MRC file.
+    Computed in float64, so int16 -32768 does not wrap and NaN carries through to the result.
+    """
+    values = [np.abs(image, dtype=np.float64).max() for _, image in _iter_images(mrc, filename, items)]
+    return float(np.max(values, initial=0.0))
+
+
+def _max_abs_value(filename, items, input_dir, handles):
+    """
+    Return the largest absolute pixel value among the requested images of one MRC file.
+    A handle already in handles is used and left open for _load_file.
+    """
+    mrc = handles.get(filename)
+    if mrc is not None:
+        return _images_max_abs(mrc, filename, items)
+    
+    with _open_mrc(os.path.join(input_dir, filename)) as mrc:
+        return _images_max_abs(mrc, filename, items)
+
+
+def _int16_scale(executor, groups, input_dir, handles):
+    """
+    Return the factor that maps the largest absolute value among the
+    referenced images to 32767.
+    """
+    max_abs = np.max(list(executor.map(lambda group: _max_abs_value(*group, input_dir, handles), groups.items())))
+    if not np.isfinite(max_abs):
+        raise ValueError("int16 output needs finite pixel values, but the images contain NaN or inf")
+    return 32767 / float(max_abs) if max_abs > 0 else 1.0
+
+
+def _load_file(filename, items, input_dir, out, handles, scale=None):
+    """
+    Copy the requested images of one MRC file into the output stack.
+    items is a list of (output_position, image_index) pairs.
+    handles maps filenames to files that are already open; a handle
+    taken from it is closed here once its images are copied.
+    If scale is given, images are multiplied by it, rounded and clipped
+    to the int16 range before being stored. For float16 output, images
+    with values beyond the float16 range raise ValueError.
+    """
+    mrc = handles.pop(filename, None)
+    if mrc is None:
+        mrc = _open_mrc(os.path.join(input_dir, filename))
+    
+    with mrc:
+        if mrc.data.shape[-2:] != out.shape[1:]:
+            raise ValueError(f"Image size {mrc.data.shape[-2:]} in file {filename} does not match {out.shape[1:]}")
+        for out_pos, image in _iter_images(mrc, filename, items):
+            if scale is not None:
+                out[out_pos] = np.clip(np.rint(image * scale), -32767, 32767)
+                continue
+            if out.dtype == np.float16 and np.abs(image, dtype=np.float64).max() > _FLOAT16_MAX:
+                raise ValueError(f"Pixel values in file {filename} exceed the float16 range; use float32 or int16 output")
+            out[out_pos] = image
+
+
+def process_images(df, image_column, input_dir, output_stack_path, output_dtype='float32'):
     """
     Process images in the order they appear in the star file,
     concatenate them, and save as a new stack.
+    output_dtype is one of 'float32', 'float16' or 'int16'; int16 output
+    is scaled so the largest absolute pixel value maps to 32767, and
+    float16 output raises ValueError if values exceed the float16 range.
     Returns updated DataFrame with new image references.
     """
-    # Parse image references
-    image_refs = []
-    for ref in df[image_column]:
-        idx, filename = parse_image_reference(ref)
-        image_refs.append((idx, filename))
-    
-    # Sort by original order in star file
-    image_refs_sorted = sorted(enumerate(image_refs), key=lambda x: x[0])
-    
-    # Load images
-    images = []
-    for orig_idx, (img_idx, filename) in image_refs_sorted:
-        filepath = os.path.join(input_dir, filename)
-        if not os.path.exists(filepath):
-            raise FileNotFoundError(f"MRC file not found: {filepath}")
+    if output_dtype not in _MRC_MODES:
+        raise ValueError(f"Unsupported output dtype: {output_dtype}")
+    
+    # Parse image references in one vectorized pass
+    parts = df[image_column].str.extract(_REF_RE)
+    invalid = parts[0].isna()
+    if invalid.any():
+        # Report the first bad reference through the scalar parser so the error has one source
+        parse_image_reference(df[image_column][invalid].iloc[0])
+    indices = parts[0].astype(np.int64).to_numpy()
+    filenames = parts[1].to_numpy()
+    
+    # Group references by file so each MRC file is opened only once
+    groups = defaultdict(list)
+    for out_pos, (img_idx, filename) in enumerate(zip(indices, filenames)):
+        groups[filename].append((out_pos, img_idx))
+    
+    if not groups:
+        raise ValueError("No image references found in star file")
+    
+    # Size the output stack from the first referenced file, keeping it open for reading
+    handles = {filenames[0]: _open_mrc(os.path.join(input_dir, filenames[0]))}
+    image_shape = handles[filenames[0]].data.shape[-2:]
+    
+    # Only replace the output once every image has loaded
+    partial_path = f"{output_stack_path}.partial"
+    try:
+        with ThreadPoolExecutor(max_workers=min(32, len(groups))) as executor:
+            # int16 needs the value range up front, as the output is written in one pass
+            scale = _int16_scale(executor, groups, input_dir, handles) if output_dtype == 'int16' else None
+            
+            # Stream images straight into a memory-mapped stack next to the output
+            with mrcfile.new_mmap(partial_path, shape=(len(df),) + image_shape,
+                                  mrc_mode=_MRC_MODES[output_dtype], overwrite=True) as out_mrc:
+                # Files are independent and write to disjoint output slots, so read them in parallel
+                list(executor.map(lambda group: _load_file(*group, input_dir, out_mrc.data, handles, scale),
+                                  groups.items()))
+                
+                out_mrc.update_header_stats()
+                if scale is not None:
+                    out_mrc.add_label(f"Pixel values multiplied by {scale:.6g} for int16 output")
         
-        with mrcfile.open(filepath) as mrc:
-            # Extract the specific image from the stack
-            if mrc.data.ndim == 3:  # It's a stack
-                if img_idx >= mrc.data.shape[0]:
-                    raise IndexError(f"Image index {img_idx} out of bounds for file {filename}")
-                images.append(mrc.data[img_idx].copy())
-            else:  # It's a single image
-                if img_idx != 0:
-                    raise IndexError(f"Image index {img_idx} invalid for single image file {filename}")
-                images.append(mrc.data.copy())
-    
-    # Stack images
-    image_stack = np.stack(images, axis=0)
-    
-    # Save as new MRC stack
-    with mrcfile.new(output_stack_path, overwrite=True) as mrc:
-        mrc.set_data(image_stack.astype(np.float32))
+        os.replace(partial_path, output_stack_path)
+    except Exception:
+        # Leave any existing output untouched and remove the partly written stack
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    finally:
+        # Close any handle left unused by a failed run
+        for mrc in handles.values():
+            mrc.close()
     
     # Update image references in DataFrame
     output_filename = os.path.basename(output_stack_path)
-    for i in range(len(df)):
-        df.at[i, image_column] = f"{i:06d}@{output_filename}"
+    idx_strs = np.char.zfill(np.arange(len(df)).astype(str), 6)
+    df[image_column] = np.char.add(idx_strs, f"@{output_filename}")
     
     return df
 
 
-def save_star_file(df, output_path, original_star_path):
+def save_star_file(df, output_path, header_text):
     """
     Save the updated DataFrame as a star file, preserving the original format.
+    header_text is the header returned by read_star_file.
     """
-    # Read the original file to get the header
-    with open(original_star_path, 'r') as f:
-        lines = f.readlines()
-    
-    header_lines = []
-    data_start = None
-    for i, line in enumerate(lines):
-        if line.strip() == "loop_":
-            data_start = i
-            header_lines = lines[:data_start+1]
-            break
-    
-if data_start is None:
-        raise ValueError("Could not find 'loop_' in original star file")
-    
-    # Get column headers
-    column_headers = []
-    i = data_start + 1
-    while i < len(lines) and lines[i].strip() and lines[i].strip()[0] == '_':
-        column_headers.append(lines[i].strip())
-        i += 1
-    
-    # Write the new star file
     with open(output_path, 'w') as f:
         # Write the header
-        f.writelines(header_lines)
-        
-        # Write column headers
-        for header in column_headers:
-            f.write(f"{header}\n")
+        f.write(header_text)
         
         # Write data
-        for _, row in df.iterrows():
-            f.write(' '.join(str(val) for val in row) + '\n')
+        df.to_csv(f, sep=' ', header=False, index=False, lineterminator='\n')
 
 
 def main():
@@ -156,20 +282,22 @@ def main():
     parser.add_argument('--output_stack', required=True, help='Output MRC stack file')
     parser.add_argument('--output_star', required=True, help='Output star file')
     parser.add_argument('--image_column', default='rlnImageName', help='Column name for image references')
+    parser.add_argument('--output_dtype', default='float32', choices=list(_MRC_MODES),
+                        help='Data type of the output stack (int16 is rescaled to the full int16 range)')
     
     args = parser.parse_args()
     
     # Read star file
     print(f"Reading star file: {args.star_file}")
-    df = read_star_file(args.star_file, args.image_column)
+    df, header_text = read_star_file(args.star_file, args.image_column)
     
     # Process images
     print(f"Processing images from directory: {args.input_dir}")
-    df = process_images(df, args.image_column, args.input_dir, args.output_stack)
+    df = process_images(df, args.image_column, args.input_dir, args.output_stack, args.output_dtype)
     
     # Save updated star file
     print(f"Saving updated star file: {args.output_star}")
-    save_star_file(df, args.output_star, args.star_file)
+    save_star_file(df, args.output_star, header_text)
     
     print("Done!")
 
@@ -3,7 +3,7 @@ import pytest
 import numpy as np
 import mrcfile
 import pandas as pd
-from combine_mrc_stacks import parse_image_reference, read_star_file, process_images
+from combine_mrc_stacks import parse_image_reference, read_star_file, process_images, save_star_file
 
 def test_parse_image_reference():
     # Test valid reference
@@ -27,11 +27,98 @@ _rlnImageName
         f.write(star_content)
     
     # Test reading the star file
-    df = read_star_file("tests/test_data/test.star", "rlnImageName")
+    df, header_text = read_star_file("tests/test_data/test.star", "rlnImageName")
+    assert header_text == "data_particles\nloop_\n_rlnImageName\n"
     assert len(df) == 2
     assert df.iloc[0]["rlnImageName"] == "000001@test1.mrc"
     assert df.iloc[1]["rlnImageName"] == "000002@test2.mrc"
 
+def test_save_star_file():
+    # Create a temporary star file
+    star_content = """data_particles
+loop_
+_rlnImageName #1
+_rlnCoordinateX #2
+_rlnAngleRot #3
+_rlnDefocusU #4
+_rlnGroupNumber #5
+000001@test1.mrc 987.654321 179.999999 12345.678711 007
+000002@test2.mrc 1234.567890 -97.123456 13000.500000 1
+"""
+    with open("tests/test_data/test.star", "w") as f:
+        f.write(star_content)
+    
+    df, header_text = read_star_file("tests/test_data/test.star", "rlnImageName")
+    assert df.iloc[1]["rlnDefocusU"] == "13000.500000"
+    assert df.iloc[0]["rlnGroupNumber"] == "007"
+    df["rlnImageName"] = ["000000@output.mrc", "000001@output.mrc"]
+    
+    # Test writing the star file with the original header and values kept as written
+    save_star_file(df, "tests/test_data/output.star", header_text)
+    with open("tests/test_data/output.star") as f:
+        assert f.read() == """data_particles
+loop_
+_rlnImageName #1
+_rlnCoordinateX #2
+_rlnAngleRot #3
+_rlnDefocusU #4
+_rlnGroupNumber #5
+000000@output.mrc 987.654321 179.999999 12345.678711 007
+000001@output.mrc 1234.567890 -97.123456 13000.500000 1
+"""
+    
+    # Clean up
+    os.remove("tests/test_data/output.star")
+
+def test_save_star_file_keeps_na_tokens():
+    # Create a star file with NA-like tokens in a string column
+    star_content = """data_particles
+loop_
+_rlnImageName #1
+_rlnGroupName #2
+000001@test1.mrc NA
+000002@test2.mrc null
+"""
+    with open("tests/test_data/test.star", "w") as f:
+        f.write(star_content)
+    
+    df, header_text = read_star_file("tests/test_data/test.star", "rlnImageName")
+    assert list(df["rlnGroupName"]) == ["NA", "null"]
+    
+    # Test the tokens are written back verbatim
+    save_star_file(df, "tests/test_data/output.star", header_text)
+    with open("tests/test_data/output.star") as f:
+        assert f.read() == star_content
+    
+    # Clean up
+    os.remove("tests/test_data/output.star")
+
+def test_save_star_file_keeps_hash_in_field():
+    # Create a star file with '#' inside a field and a whole-line comment
+    star_content = """data_particles
+loop_
+_rlnImageName #1
+_rlnMicrographName #2
+_rlnDefocusU #3
+000001@test1.mrc mic#1.mrc 13000.5
+# a comment line with several tokens
+000002@test2.mrc mic#2.mrc 14000.5
+"""
+    with open("tests/test_data/test.star", "w") as f:
+        f.write(star_content)
+    
+    df, header_text = read_star_file("tests/test_data/test.star", "rlnImageName")
+    assert len(df) == 2
+    assert list(df["rlnMicrographName"]) == ["mic#1.mrc", "mic#2.mrc"]
+    
+    # Test the field is written back whole and the comment line is dropped
+    save_star_file(df, "tests/test_data/output.star", header_text)
+    with open("tests/test_data/output.star") as f:
+        assert f.read() == star_content.replace("# a comment line with several tokens\n", "")
+    
+    # Clean up
+    os.remove("tests/test_data/output.star")
+
 def test_process_images():
     # Create test MRC files
     test_data = np.random.rand(2, 10, 10).astype(np.float32)
@@ -62,4 +149,192 @@ def test_process_images():
     # Clean up
     os.remove("tests/test_data/test1.mrc")
     os.remove("tests/test_data/test2.mrc")
-    os.remove(output_stack) 
\ No newline at end of file
+    os.remove(output_stack) 
+
+def test_process_images_invalid_reference():
+    df = pd.DataFrame({
+        "rlnImageName": ["000000@test1.mrc", "invalid_reference"]
+    })
+    
+    # Test invalid reference is reported by parse_image_reference
+    with pytest.raises(ValueError, match="Invalid image reference format: invalid_reference"):
+        process_images(df, "rlnImageName", "tests/test_data", "tests/test_data/output.mrc")
+
+def test_process_images_preserves_star_order():
+    # Create a stack and a single image, referenced out of order
+    stack_data = np.random.rand(3, 10, 10).astype(np.float32)
+    single_data = np.random.rand(10, 10).astype(np.float32)
+    
+    with mrcfile.new("tests/test_data/stack.mrcs", overwrite=True) as mrc:
+        mrc.set_data(stack_data)
+    
+    with mrcfile.new("tests/test_data/single.mrc", overwrite=True) as mrc:
+        mrc.set_data(single_data)
+    
+    df = pd.DataFrame({
+        "rlnImageName": ["000002@stack.mrcs", "000000@single.mrc", "000000@stack.mrcs"]
+    })
+    
+    output_stack = "tests/test_data/output.mrc"
+    process_images(df, "rlnImageName", "tests/test_data", output_stack)
+    
+    # Verify images are written in star file order
+    with mrcfile.open(output_stack) as mrc:
+        assert mrc.data.shape == (3, 10, 10)
+        np.testing.assert_array_equal(mrc.data[0], stack_data[2])
+        np.testing.assert_array_equal(mrc.data[1], single_data)
+        np.testing.assert_array_equal(mrc.data[2], stack_data[0])
+    
+    # Clean up
+    os.remove("tests/test_data/stack.mrcs")
+    os.remove("tests/test_data/single.mrc")
+    os.remove(output_stack)
+
+def test_process_images_converts_int16_to_float32():
+    # Create an int16 stack, as written by many detectors
+    stack_data = np.random.randint(-1000, 1000, size=(2, 10, 10)).astype(np.int16)
+    
+    with mrcfile.new("tests/test_data/stack_int16.mrcs", overwrite=True) as mrc:
+        mrc.set_data(stack_data)
+    
+    df = pd.DataFrame({
+        "rlnImageName": ["000001@stack_int16.mrcs", "000000@stack_int16.mrcs"]
+    })
+    
+    output_stack = "tests/test_data/output.mrc"
+    process_images(df, "rlnImageName", "tests/test_data", output_stack)
+    
+    # Verify the output is float32 with the same values
+    with mrcfile.open(output_stack) as mrc:
+        assert mrc.data.dtype == np.float32
+        np.testing.assert_array_equal(mrc.data[0], stack_data[1].astype(np.float32))
+        np.testing.assert_array_equal(mrc.data[1], stack_data[0].astype(np.float32))
+    
+    # Clean up
+    os.remove("tests/test_data/stack_int16.mrcs")
+    os.remove(output_stack)
+
+def test_process_images_int16_output():
+    # Create a float32 stack to be written out as int16
+    stack_data = np.random.uniform(-2, 4, size=(2, 10, 10)).astype(np.float32)
+    
+    with mrcfile.new("tests/test_data/stack.mrcs", overwrite=True) as mrc:
+        mrc.set_data(stack_data)
+    
+    df = pd.DataFrame({
+        "rlnImageName": ["000000@stack.mrcs", "000001@stack.mrcs"]
+    })
+    
+    output_stack = "tests/test_data/output.mrc"
+    process_images(df, "rlnImageName", "tests/test_data", output_stack, output_dtype="int16")
+    
+    # Verify the output is int16, scaled to the full int16 range
+    scale = 32767 / float(np.abs(stack_data).max())
+    with mrcfile.open(output_stack) as mrc:
+        assert mrc.data.dtype == np.int16
+        assert np.abs(mrc.data).max() == 32767
+        np.testing.assert_array_equal(mrc.data, np.rint(stack_data * scale).astype(np.int16))
+    
+    # Test unsupported output dtype
+    with pytest.raises(ValueError):
+        process_images(df, "rlnImageName", "tests/test_data", output_stack, output_dtype="uint8")
+    
+    # Clean up
+    os.remove("tests/test_data/stack.mrcs")
+    os.remove(output_stack)
+
+def test_process_images_int16_output_from_int16_source():
+    # Create an int16 stack holding the most negative int16 value
+    stack_data = np.array([[[-32768, 100], [5, 6]]], dtype=np.int16)
+    
+    with mrcfile.new("tests/test_data/stack_int16.mrcs", overwrite=True) as mrc:
+        mrc.set_data(stack_data)
+    
+    df = pd.DataFrame({
+        "rlnImageName": ["000000@stack_int16.mrcs"]
+    })
+    
+    output_stack = "tests/test_data/output.mrc"
+    process_images(df, "rlnImageName", "tests/test_data", output_stack, output_dtype="int16")
+    
+    # Verify -32768 sets the scale and is stored without wrapping
+    scale = 32767 / 32768
+    with mrcfile.open(output_stack) as mrc:
+        np.testing.assert_array_equal(mrc.data, np.rint(stack_data * scale).astype(np.int16))
+        assert mrc.data[0, 0, 0] == -32767
+    
+    # Clean up
+    os.remove("tests/test_data/stack_int16.mrcs")
+    os.remove(output_stack)
+
+def test_process_images_int16_output_rejects_nan():
+    # Create a float32 stack with a NaN pixel
+    stack_data = np.random.rand(1, 10, 10).astype(np.float32)
+    stack_data[0, 3, 4] = np.nan
+    
+    with mrcfile.new("tests/test_data/stack.mrcs", overwrite=True) as mrc:
+        with pytest.warns(RuntimeWarning):
+            mrc.set_data(stack_data)
+    
+    df = pd.DataFrame({
+        "rlnImageName": ["000000@stack.mrcs"]
+    })
+    
+    # Test int16 output refuses non-finite pixel values
+    with pytest.raises(ValueError, match="finite"):
+        process_images(df, "rlnImageName", "tests/test_data", "tests/test_data/output.mrc", output_dtype="int16")
+    assert not os.path.exists("tests/test_data/output.mrc")
+    
+    # Clean up
+    os.remove("tests/test_data/stack.mrcs")
+
+def test_process_images_float16_out_of_range():
+    # Create a stack with values beyond the float16 range
+    with mrcfile.new("tests/test_data/stack.mrcs", overwrite=True) as mrc:
+        mrc.set_data(np.full((1, 10, 10), 70000, dtype=np.float32))
+    
+    df = pd.DataFrame({
+        "rlnImageName": ["000000@stack.mrcs"]
+    })
+    
+    # Test float16 output refuses values it cannot represent
+    with pytest.raises(ValueError, match="float16 range"):
+        process_images(df, "rlnImageName", "tests/test_data", "tests/test_data/output.mrc", output_dtype="float16")
+    assert not os.path.exists("tests/test_data/output.mrc")
+    
+    # Clean up
+    os.remove("tests/test_data/stack.mrcs")
+
+def test_process_images_missing_file():
+    df = pd.DataFrame({
+        "rlnImageName": ["000000@missing.mrc"]
+    })
+    
+    # Test missing MRC file
+    with pytest.raises(FileNotFoundError, match="MRC file not found"):
+        process_images(df, "rlnImageName", "tests/test_data", "tests/test_data/output.mrc")
+
+def test_process_images_failure_keeps_existing_output():
+    # Create an existing output stack and a source stack
+    keep_data = np.random.rand(2, 10, 10).astype(np.float32)
+    with mrcfile.new("tests/test_data/keep.mrcs", overwrite=True) as mrc:
+        mrc.set_data(keep_data)
+    
+    with mrcfile.new("tests/test_data/stack.mrcs", overwrite=True) as mrc:
+        mrc.set_data(np.random.rand(2, 10, 10).astype(np.float32))
+    
+    df = pd.DataFrame({
+        "rlnImageName": ["000000@stack.mrcs", "000001@stack.mrcs", "000005@stack.mrcs"]
+    })
+    
+    # Test an out of range index leaves the existing output unchanged
+    with pytest.raises(IndexError):
+        process_images(df, "rlnImageName", "tests/test_data", "tests/test_data/keep.mrcs")
+    
+    with mrcfile.open("tests/test_data/keep.mrcs") as mrc:
+        np.testing.assert_array_equal(mrc.data, keep_data)
+    assert not os.path.exists("tests/test_data/keep.mrcs.partial")
+    
+    # Clean up
+    os.remove("tests/test_data/keep.mrcs")
+    os.remove("tests/test_data/stack.mrcs")